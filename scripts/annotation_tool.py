@@ -1,6 +1,15 @@
+import glob
+import hashlib
+import io
+import json
+import os
+from datetime import datetime
+
 import streamlit as st
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+from sortedcontainers import SortedList
 
 st.set_page_config(page_title="Phishing Annotation Tool", layout="wide", page_icon="📧")
 
@@ -93,44 +102,249 @@ CLASS_LABELS = {
     3: "Credential",
     4: "Generic/Deceptive",
 }
+CLASS_ITEMS = list(CLASS_LABELS.items())
+# Labels accepted from uploaded CSVs and the progress log; 0 is the legacy Legitimate class
+VALID_LABELS = (0, *CLASS_LABELS)
+
+# Header status badge, indexed by 0 = pending, 1 = skipped, 2 = annotated
+STATUS_TABLE = [("○", "status-pending"), (">", "status-skip"), ("✓", "status-done")]
+
+# Append-only per-annotator mutation logs, replayed on login
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'annotation_logs')
+LOG_FIELDS = ['idx', 'label', 'skipped', 'remarks', 'ts']
+# Memory-mapped Arrow copies of each uploaded file's text column
+TEXT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'annotation_cache')
+# Parsed uploads kept in process memory; older files are evicted and re-parsed on demand
+SOURCE_CACHE_ENTRIES = 3
 
-def init_progress(df, annotator_id):
-    df = df.copy()
+def get_source_key(file_bytes):
+    return hashlib.md5(file_bytes).hexdigest()[:12]
+
+@st.cache_resource(show_spinner=False, max_entries=SOURCE_CACHE_ENTRIES)
+def load_source(file_bytes):
+    # One read-only frame per uploaded file, shared by every annotator session (no per-session copy)
+    df = pd.read_csv(io.BytesIO(file_bytes))
+    
+    # Auto-detect text column
+    text_col = None
+    for col in ['body', 'text', 'text_cleaned', 'content', 'email']:
+        if col in df.columns:
+            text_col = col
+            break
+    if text_col is None:
+        return None, None
+    
+    df = map_text_column(df, text_col, get_source_key(file_bytes))
+    return init_progress(df), text_col
+
+def map_text_column(df, text_col, source_key):
+    # Email bodies go to an Arrow IPC file that is memory-mapped back in, so the OS pages in
+    # only the emails actually displayed instead of holding every string on the heap
+    path = os.path.join(TEXT_CACHE_DIR, f"{source_key}.arrow")
+    if not os.path.exists(path):
+        os.makedirs(TEXT_CACHE_DIR, exist_ok=True)
+        table = pa.table({'text': pa.array(df[text_col].astype('string[pyarrow]'), type=pa.large_string())})
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+    else:
+        # Mark as recently used so pruning keeps it
+        os.utime(path)
+    text = pa.ipc.open_file(pa.memory_map(path)).read_all().column('text')
+    prune_text_cache()
+    df[text_col] = pd.arrays.ArrowStringArray(text)
+    # Standardize column name (shares the mapped buffers, no copy)
+    df['text_cleaned'] = df[text_col]
+    return df
+
+def prune_text_cache():
+    # Keep as many mapped files on disk as load_source keeps in memory, least recently used go first.
+    # Unlinking a file that is still mapped is safe on POSIX; where the OS refuses, retry next time
+    paths = sorted(glob.glob(os.path.join(TEXT_CACHE_DIR, '*.arrow')), key=os.path.getmtime, reverse=True)
+    for stale in paths[SOURCE_CACHE_ENTRIES:]:
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+
+def init_progress(df):
     # Preserve existing annotations if the uploaded CSV already has them
     if 'annotation_label' not in df.columns:
-        df['annotation_label'] = np.nan
+        df['annotation_label'] = pd.NA
     else:
-        df['annotation_label'] = pd.to_numeric(df['annotation_label'], errors='coerce')
+        labels = pd.to_numeric(df['annotation_label'], errors='coerce')
+        # Fractional or out-of-range labels become missing so the Int8 cast below cannot fail
+        df['annotation_label'] = labels.where(labels.isin(VALID_LABELS))
     if 'annotator_remarks' not in df.columns:
         df['annotator_remarks'] = ''
     else:
         df['annotator_remarks'] = df['annotator_remarks'].fillna('')
     if 'is_skipped' not in df.columns:
         df['is_skipped'] = False
-    else:
-        df['is_skipped'] = df['is_skipped'].astype(bool)
-    df['annotator_id'] = annotator_id
+    # Arrow-backed strings and a nullable Int8 label keep the frame compact and isna() cheap
+    df = df.astype({
+        'text_cleaned': 'string[pyarrow]',
+        'annotation_label': 'Int8',
+        'is_skipped': 'bool',
+        'annotator_remarks': 'string[pyarrow]',
+    })
     return df
 
-@st.cache_data
-def get_pending_mask(_df):
-    return _df['annotation_label'].isna() & ~_df['is_skipped']
+def init_annotation_state(df):
+    # Per-session writable state: the shared frame is only referenced, its mutable
+    # columns are copied into plain NumPy arrays (label -1 = unset); handlers write arr[idx] = v
+    labels = df['annotation_label'].fillna(-1).to_numpy(dtype=np.int8, copy=True)
+    skipped = df['is_skipped'].to_numpy(dtype=bool, copy=True)
+    st.session_state.labels = labels
+    st.session_state.skipped = skipped
+    st.session_state.remarks = df['annotator_remarks'].to_numpy(dtype=object, copy=True)
+    st.session_state.progress_df = df
+    replay_log(labels, skipped, st.session_state.remarks)
+    # Build the pending-index structure and counters once; handlers keep them in sync
+    st.session_state.pending = SortedList(np.flatnonzero((labels < 0) & ~skipped).tolist())
+    st.session_state.skipped_idx = SortedList(np.flatnonzero(skipped).tolist())
+    st.session_state.n_annotated = int((labels >= 0).sum())
+    st.session_state.n_skipped = int(skipped.sum())
+
+def get_log_path():
+    # One log per annotator and uploaded file, so row indices always refer to the same CSV
+    return os.path.join(LOG_DIR, f"{st.session_state.annotator_id}_{st.session_state.source_key}.jsonl")
+
+def append_log(idx):
+    # Append one JSON line per mutation instead of re-encoding the whole CSV. JSON escapes newlines
+    # inside remarks, so a line torn by a crash can only ever damage itself
+    path = get_log_path()
+    needs_newline = False
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        # Terminate a line left unfinished by a crash so the new entry starts on its own line
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+    else:
+        os.makedirs(LOG_DIR, exist_ok=True)
+    entry = {
+        'idx': int(idx),
+        'label': int(st.session_state.labels[idx]),
+        'skipped': bool(st.session_state.skipped[idx]),
+        'remarks': st.session_state.remarks[idx] or '',
+        'ts': datetime.now().isoformat(timespec='seconds'),
+    }
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(('\n' if needs_newline else '') + json.dumps(entry) + '\n')
+
+def replay_log(labels, skipped, remarks):
+    path = get_log_path()
+    if not os.path.exists(path):
+        return
+    latest = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            parsed = parse_log_entry(line, len(labels))
+            # The latest well-formed entry per email wins; lines torn by a crash are dropped
+            if parsed is not None:
+                latest[parsed[0]] = parsed
+    for idx, label, is_skipped, remark in latest.values():
+        labels[idx] = label
+        skipped[idx] = is_skipped
+        remarks[idx] = remark
+
+def parse_log_entry(line, total):
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(entry, dict) or sorted(entry) != sorted(LOG_FIELDS):
+        return None
+    idx, label = entry['idx'], entry['label']
+    # bool is an int subclass, so check the exact types
+    if type(idx) is not int or type(label) is not int or type(entry['skipped']) is not bool:
+        return None
+    if not isinstance(entry['remarks'], str) or not isinstance(entry['ts'], str):
+        return None
+    try:
+        datetime.fromisoformat(entry['ts'])
+    except ValueError:
+        return None
+    if not 0 <= idx < total or (label != -1 and label not in VALID_LABELS):
+        return None
+    return idx, label, entry['skipped'], entry['remarks']
+
+def build_progress_df():
+    # Overlay this session's arrays on the shared frame; assign() leaves the shared frame untouched
+    labels = st.session_state.labels
+    return st.session_state.progress_df.assign(
+        annotation_label=pd.arrays.IntegerArray(labels, labels < 0),
+        annotator_remarks=st.session_state.remarks,
+        is_skipped=st.session_state.skipped,
+        annotator_id=st.session_state.annotator_id,
+    )
 
 def get_next_unannotated(current_idx, total):
-    pending = st.session_state.progress_df['annotation_label'].isna() & ~st.session_state.progress_df['is_skipped']
+    pending = st.session_state.pending
     # Search after current
-    after_idx = pending.iloc[current_idx + 1:]
-    if after_idx.any():
-        return after_idx.idxmax()
+    after_idx = next(pending.irange(minimum=current_idx + 1), None)
+    if after_idx is not None:
+        return after_idx
     # Wrap to beginning
-    before_idx = pending.iloc[:current_idx]
-    if before_idx.any():
-        return before_idx.idxmax()
+    if pending and pending[0] < current_idx:
+        return pending[0]
     return min(current_idx + 1, total - 1)
 
+def is_csv_current():
+    cached = st.session_state.csv_cache
+    return cached is not None and cached[0] == st.session_state.progress_version
+
+def get_csv_bytes():
+    # Re-serialize only when a handler has bumped progress_version since the last call
+    if not is_csv_current():
+        data = build_progress_df().to_csv(index=False).encode('utf-8')
+        st.session_state.csv_cache = (st.session_state.progress_version, data)
+    return st.session_state.csv_cache[1]
+
 def get_prev_index(current_idx):
     return max(0, current_idx - 1)
 
+# Fragment: editing/saving notes reruns only this panel; class clicks call st.rerun() for the full app
+@st.fragment
+def annotation_panel(current_idx, total):
+    labels = st.session_state.labels
+    skipped = st.session_state.skipped
+    # Class selection buttons
+    selected = int(labels[current_idx])  # -1 when unset
+    button_types = ["primary" if selected == k else "secondary" for k, _ in CLASS_ITEMS]
+    
+    st.markdown("##### 🏷️ Select Class")
+    btn_cols = st.columns(4)
+    for i, (k, v) in enumerate(CLASS_ITEMS):
+        with btn_cols[i]:
+            if st.button(f"{k}", key=f"cls_{k}", use_container_width=True, type=button_types[i], help=v):
+                if selected < 0:
+                    st.session_state.n_annotated += 1
+                if skipped[current_idx]:
+                    st.session_state.n_skipped -= 1
+                    st.session_state.skipped_idx.discard(current_idx)
+                labels[current_idx] = k
+                skipped[current_idx] = False
+                st.session_state.pending.discard(current_idx)
+                st.session_state.progress_version += 1
+                append_log(current_idx)
+                st.session_state.current_idx = get_next_unannotated(current_idx, total)
+                st.rerun()
+    
+    # Show selected class name
+    if selected in CLASS_LABELS:
+        st.markdown(f"<div style='text-align:center;color:#667eea;font-size:13px;margin:-5px 0 10px 0;'>Selected: <b>{CLASS_LABELS[selected]}</b></div>", unsafe_allow_html=True)
+    
+    st.markdown("##### 📝 Notes")
+    remarks = st.text_area("", value=st.session_state.remarks[current_idx] or '', height=60, key=f"remarks_{current_idx}", label_visibility="collapsed", placeholder="Optional remarks...")
+    
+    if remarks and st.button("💾 Save Notes", use_container_width=True, type="secondary"):
+        st.session_state.remarks[current_idx] = remarks
+        st.session_state.progress_version += 1
+        append_log(current_idx)
+        st.toast("Notes saved!", icon="✅")
+
 # Initialize session state
 if 'annotator_id' not in st.session_state:
     st.session_state.annotator_id = None
@@ -153,29 +367,20 @@ if not st.session_state.data_loaded:
     uploaded_file = st.file_uploader("Upload CSV file", type=['csv'])
     
     if uploaded_file is not None:
-        df = pd.read_csv(uploaded_file)
-        
-        # Auto-detect text column
-        text_col = None
-        for col in ['body', 'text', 'text_cleaned', 'content', 'email']:
-            if col in df.columns:
-                text_col = col
-                break
+        file_bytes = uploaded_file.getvalue()
+        df, text_col = load_source(file_bytes)
         
         if text_col is None:
             st.error("CSV must contain a text column (body, text, text_cleaned, content, or email)")
         else:
-            # Standardize column name
-            if text_col != 'text_cleaned':
-                df['text_cleaned'] = df[text_col]
-            
             st.session_state.uploaded_df = df
+            st.session_state.source_key = get_source_key(file_bytes)
             st.session_state.data_loaded = True
             st.success(f"Loaded {len(df):,} records (text column: '{text_col}')")
             st.rerun()
     
     st.markdown("### Annotation Classes")
-    for k, v in CLASS_LABELS.items():
+    for k, v in CLASS_ITEMS:
         st.write(f"**{k}**: {v}")
 
 elif st.session_state.annotator_id is None:
@@ -185,20 +390,19 @@ elif st.session_state.annotator_id is None:
         with ann_cols[i-1]:
             if st.button(f"{i}", key=f"ann_{i}", use_container_width=True):
                 st.session_state.annotator_id = f"Annotator_{i}"
-                st.session_state.progress_df = init_progress(st.session_state.uploaded_df, st.session_state.annotator_id)
+                init_annotation_state(st.session_state.uploaded_df)
+                st.session_state.progress_version = 0
+                st.session_state.csv_cache = None
                 # Auto-jump to first unannotated item so annotators resume where they left off
-                pending = st.session_state.progress_df['annotation_label'].isna() & ~st.session_state.progress_df['is_skipped']
-                if pending.any():
-                    st.session_state.current_idx = int(pending.idxmax())
-                else:
-                    st.session_state.current_idx = 0
+                pending = st.session_state.pending
+                st.session_state.current_idx = pending[0] if pending else 0
                 st.rerun()
     
     st.title("Phishing Email Annotation Tool")
     st.write("Please select your Annotator ID (1-4) in the sidebar to begin.")
     
     st.markdown("### Annotation Classes")
-    for k, v in CLASS_LABELS.items():
+    for k, v in CLASS_ITEMS:
         st.write(f"**{k}**: {v}")
 
 else:
@@ -210,8 +414,8 @@ else:
     total = len(progress_df)
     
     # Fast stats
-    annotated = int(progress_df['annotation_label'].notna().sum())
-    skipped = int(progress_df['is_skipped'].sum())
+    annotated = st.session_state.n_annotated
+    skipped = st.session_state.n_skipped
     remaining = total - annotated - skipped
     pct = (annotated / total) * 100 if total > 0 else 0
     
@@ -243,26 +447,27 @@ else:
         if st.button("📋", key="sidebar_skipped", help="View skipped emails"):
             st.session_state.view_skipped = True
     with c2:
-        csv_data = progress_df.to_csv(index=False).encode('utf-8')
-        st.download_button("💾", csv_data, f"{st.session_state.annotator_id}_annotations.csv", "text/csv", help="Download annotations")
+        # Serialize only on request: labelling reruns never call to_csv, and the prepared
+        # bytes stay downloadable until the next edit makes them stale
+        if is_csv_current():
+            st.download_button("💾", get_csv_bytes(), f"{st.session_state.annotator_id}_annotations.csv", "text/csv", help="Download annotations")
+        elif st.button("📦", key="sidebar_prepare", help="Prepare download"):
+            get_csv_bytes()
+            st.rerun()
     with c3:
         if st.button("🚪", key="sidebar_logout", help="Logout (download first!)"):
             st.session_state.annotator_id = None
             st.session_state.progress_df = None
+            st.session_state.pending = None
+            st.session_state.csv_cache = None
             st.session_state.current_idx = 0
             st.rerun()
 
     row = progress_df.iloc[current_idx]
     
     # Status
-    label_val = row['annotation_label']
-    is_annotated = pd.notna(label_val)
-    if is_annotated:
-        status_icon, status_class = "✓", "status-done"
-    elif row['is_skipped']:
-        status_icon, status_class = ">", "status-skip"
-    else:
-        status_icon, status_class = "○", "status-pending"
+    status = 2 if st.session_state.labels[current_idx] >= 0 else int(st.session_state.skipped[current_idx])
+    status_icon, status_class = STATUS_TABLE[status]
     
     # Header
     source = row.get('source_dataset', 'Unknown')
@@ -285,7 +490,13 @@ else:
             st.rerun()
     with nav_cols[2]:
         if st.button("Skip >", key="btn_skip", use_container_width=True, help="Skip & continue"):
-            st.session_state.progress_df.at[current_idx, 'is_skipped'] = True
+            if not st.session_state.skipped[current_idx]:
+                st.session_state.n_skipped += 1
+                st.session_state.skipped_idx.add(current_idx)
+            st.session_state.skipped[current_idx] = True
+            st.session_state.pending.discard(current_idx)
+            st.session_state.progress_version += 1
+            append_log(current_idx)
             st.session_state.current_idx = get_next_unannotated(current_idx, total)
             st.rerun()
     with nav_cols[3]:
@@ -307,40 +518,17 @@ else:
         st.text_area("Email Content", value=email_text, height=380, disabled=True, key=f"email_{current_idx}", label_visibility="collapsed")
     
     with right_col:
-        # Class selection buttons
-        current_label = row['annotation_label']
-        selected = int(current_label) if pd.notna(current_label) else None
-        
-        st.markdown("##### 🏷️ Select Class")
-        btn_cols = st.columns(4)
-        for i, (k, v) in enumerate(CLASS_LABELS.items()):
-            with btn_cols[i]:
-                btn_type = "primary" if selected == k else "secondary"
-                if st.button(f"{k}", key=f"cls_{k}", use_container_width=True, type=btn_type, help=v):
-                    st.session_state.progress_df.at[current_idx, 'annotation_label'] = k
-                    st.session_state.progress_df.at[current_idx, 'is_skipped'] = False
-                    st.session_state.current_idx = get_next_unannotated(current_idx, total)
-                    st.rerun()
-        
-        # Show selected class name
-        if selected:
-            st.markdown(f"<div style='text-align:center;color:#667eea;font-size:13px;margin:-5px 0 10px 0;'>Selected: <b>{CLASS_LABELS[selected]}</b></div>", unsafe_allow_html=True)
-        
-        st.markdown("##### 📝 Notes")
-        remarks = st.text_area("", value=row.get('annotator_remarks', '') if pd.notna(row.get('annotator_remarks', '')) else '', height=60, key=f"remarks_{current_idx}", label_visibility="collapsed", placeholder="Optional remarks...")
-        
-        if remarks and st.button("💾 Save Notes", use_container_width=True, type="secondary"):
-            st.session_state.progress_df.at[current_idx, 'annotator_remarks'] = remarks
-            st.toast("Notes saved!", icon="✅")
+        annotation_panel(current_idx, total)
     
     # Skipped emails modal
     if st.session_state.get('view_skipped', False):
         with st.expander("📋 Skipped Emails", expanded=True):
-            skipped_df = progress_df[progress_df['is_skipped'] == True]
-            if len(skipped_df) > 0:
-                st.caption(f"{len(skipped_df)} skipped emails")
+            # Sorted index set kept in sync by the handlers; slicing the first 24 is O(24)
+            skipped_idx = st.session_state.skipped_idx
+            if len(skipped_idx) > 0:
+                st.caption(f"{len(skipped_idx)} skipped emails")
                 cols = st.columns(8)
-                for i, idx in enumerate(skipped_df.index[:24]):
+                for i, idx in enumerate(skipped_idx[:24]):
                     with cols[i % 8]:
                         if st.button(f"{idx + 1}", key=f"skip_{idx}", use_container_width=True):
                             st.session_state.current_idx = idx